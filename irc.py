@@ -18,8 +18,11 @@
 # author Salvo "LtWorf" Tomaselli <tiposchi@tiscali.it>
 
 import atexit
+from bisect import bisect_right
 import datetime
 from enum import Enum
+from functools import lru_cache, partial
+from collections import OrderedDict, deque
 from pathlib import Path
 import re
 import select
@@ -33,6 +36,7 @@ from os.path import expanduser
 import pwd
 from socket import gethostname
 import sys
+import time
 import traceback
 import random
 
@@ -44,15 +48,38 @@ from log import *
 # How slack expresses mentioning users
 _MENTIONS_REGEXP = re.compile(r'<@([0-9A-Za-z]+)>')
 _CHANNEL_MENTIONS_REGEXP = re.compile(r'<#[A-Z0-9]+\|([A-Z0-9\-a-z]+)>')
-_URL_REGEXP = re.compile(r'<([a-z0-9\-\.]+)://([^\s\|]+)[\|]{0,1}([^<>]*)>')
+# The scheme can't contain : or /, so there is only one way to split
+# scheme and path, and the URL can't backtrack into the label
+_URL_REGEXP = re.compile(r'<([^\s|<>:/]+://[^\s|<>]+)(?:\|([^<>]*))?>')
+_URL_SPAN_REGEXP = re.compile(r'\w+://\S+')
 _RAND_REGEXP = re.compile(r'\.rand\s+([0-9]+)\s+([0-9]+)')
 
 
-_SLACK_SUBSTITUTIONS = [
-    ('&amp;', '&'),
-    ('&gt;', '>'),
-    ('&lt;', '<'),
-]
+# How slack escapes special characters
+_SLACK_ESCAPE = str.maketrans({
+    '&': '&amp;',
+    '>': '&gt;',
+    '<': '&lt;',
+})
+_SLACK_UNESCAPE_REGEXP = re.compile(r'&(amp|gt|lt);')
+_SLACK_UNESCAPE = {
+    'amp': '&',
+    'gt': '>',
+    'lt': '<',
+}
+
+# How to yell at everybody
+_SLACK_AT_REGEXP = re.compile(r'@(here|channel|everyone)')
+_ROCKET_AT_REGEXP = re.compile(r'@(yell|shout|attention)')
+
+# How to notify the user about yelling
+_SLACK_YELL_REGEXP = re.compile(rb'<!(here|channel|everyone)>')
+_ROCKET_YELL_REGEXP = re.compile(rb'@(here|channel)')
+_YELLS = {
+    b'here': b'yelling [%s]',
+    b'channel': b'YELLING LOUDER [%s]',
+    b'everyone': b'DEAFENING YELL [%s]',
+}
 
 
 class Replies(Enum):
@@ -89,8 +116,176 @@ class Provider(Enum):
 #: Inactivity days to hide a MPIM
 MPIM_HIDE_DELAY = datetime.timedelta(days=50)
 
+#: How many channels and users are cached by name
+NAME_CACHE_SIZE = 256
+
+#: Size of the reads from the IRC client
+RECV_SIZE = 65536
+
+#: Most IRC commands or slack events handled in one main loop iteration
+LOOP_BUDGET = 10
+LOOP_BUDGET_TIME = 0.01
+
+#: Milliseconds to wait before checking again on a disconnected slack
+RECONNECT_POLL = 1000
+
+#: How many channels to autojoin before serving the IRC client and slack again
+AUTOJOIN_CHUNK = 8
+
+#: Maximum length of the names sent in a single NAMREPLY
+NAMREPLY_SIZE = 400
+
+T = TypeVar('T')
+
+
+def _trie_regex(words: Iterable[str]) -> str:
+    """
+    Returns a regular expression matching any of the words.
+
+    The words are arranged in a prefix tree, so the regex
+    engine walks every common prefix only once, rather than
+    trying every single word at every position of the string.
+
+    Longer words are preferred over their prefixes.
+    """
+    trie: Dict[str, Any] = {}
+    for word in words:
+        node = trie
+        for c in word:
+            node = node.setdefault(c, {})
+        node[''] = {}
+
+    def build(node: Dict[str, Any]) -> str:
+        branches = [re.escape(c) + build(child) for c, child in sorted(node.items()) if c]
+        if not branches:
+            return ''
+        if len(branches) == 1 and '' not in node:
+            return branches[0]
+        alternatives = '(?:%s)' % '|'.join(branches)
+        return alternatives + '?' if '' in node else alternatives
+    return build(trie)
+
+
+@lru_cache(maxsize=8)
+def _compile_mentions(usernames: FrozenSet[str]) -> Tuple[re.Pattern, FrozenSet[str]]:
+    """
+    Returns the regex to find mentions of the users, and
+    the set of characters that usernames start with.
+
+    Compiling it is expensive, so it is cached. A new list
+    containing the same users reuses the same regex.
+    """
+    regex = re.compile(r'\b(?:%s)\b' % _trie_regex(usernames))
+    return regex, frozenset(i[0] for i in usernames if i)
+
+
+def _url_spans(msg: str) -> List[Tuple[int, int]]:
+    """
+    Returns the sorted positions of the URLs in the string.
+    """
+    if '://' not in msg:
+        return []
+    return [m.span() for m in _URL_SPAN_REGEXP.finditer(msg)]
+
+
+def _in_spans(pos: int, spans: List[Tuple[int, int]]) -> bool:
+    """
+    Returns True if the position falls inside one of the
+    sorted, non overlapping, spans.
+    """
+    i = bisect_right(spans, (pos, sys.maxsize)) - 1
+    return i >= 0 and pos < spans[i][1]
+
+
+@lru_cache(maxsize=4096)
+def _encode_name(name: str) -> bytes:
+    """
+    Encodes the name of a user or a channel.
+
+    The same few names are sent over and over,
+    so the encoded results are cached.
+    """
+    return name.encode('utf8')
+
+
+def _join_names(names: Iterable[bytes], size: int = NAMREPLY_SIZE) -> Iterator[bytes]:
+    """
+    Joins the names with spaces, in chunks that are not
+    longer than size, so they fit in IRC lines.
+    """
+    chunk: List[bytes] = []
+    length = 0
+    for name in names:
+        if chunk and length + len(name) > size:
+            yield b' '.join(chunk)
+            chunk = []
+            length = 0
+        chunk.append(name)
+        length += len(name) + 1
+    if chunk:
+        yield b' '.join(chunk)
+
+
+@lru_cache(maxsize=4096)
+def _encode_channel(name: str) -> bytes:
+    """
+    Encodes the name of a channel, with the leading #
+
+    The same bytes object is returned every time, so its hash
+    is computed only once when checking parted_channels.
+    """
+    return b'#' + _encode_name(name)
+
+
+def _channel_sub(m: re.Match) -> str:
+    """
+    Callback to replace a slack channel mention with #channel
+    """
+    return '#' + m.group(1)
+
+
+def _unescape_sub(m: re.Match) -> str:
+    """
+    Callback to replace an escaped character
+    """
+    return _SLACK_UNESCAPE[m.group(1)]
+
+
+def _url_sub(m: re.Match) -> str:
+    """
+    Callback to replace a slack URL with a plain URL,
+    followed by its label, if any.
+    """
+    url, label = m.groups()
+    return f'{url} ({label})' if label else url
+
 
 class Client:
+    #: Handler method for each IRC command. Commands are case insensitive.
+    _HANDLERS: Dict[bytes, str] = {
+        b'NICK': '_nickhandler',
+        b'USER': '_userhandler',
+        b'PING': '_pinghandler',
+        b'JOIN': '_joinhandler',
+        b'PRIVMSG': '_privmsghandler',
+        b'LIST': '_listhandler',
+        b'WHO': '_whohandler',
+        b'MODE': '_modehandler',
+        b'PART': '_parthandler',
+        b'AWAY': '_awayhandler',
+        b'TOPIC': '_topichandler',
+        b'KICK': '_kickhandler',
+        b'INVITE': '_invitehandler',
+        b'SENDFILE': '_sendfilehandler',
+        #QUIT
+        #CAP LS
+        b'USERHOST': '_userhosthandler',
+        b'WHOIS': '_whoishandler',
+    }
+
+    # Commands that are handled without slack, even while it is disconnected
+    _OFFLINE_COMMANDS = frozenset((b'PING', b'MODE'))
+
     def __init__(self, s, sl_client: Union[slack.Slack, rocket.Rocket], nouserlist: bool, autojoin: bool, provider: Provider):
         self.nick = b''
         self.username = b''
@@ -105,13 +300,81 @@ class Client:
         self.autojoin = autojoin
         self._usersent = False  # Used to hold all events until the IRC client sends the initial USER message
         self._held_events: List[slack.SlackEvent] = []
+        self._autojoin_queue: Deque[slack.Channel] = deque()
         self._magic_users_id = 0
         self._magic_regex: Optional[re.Pattern] = None
-
+        self._magic_firstchars: FrozenSet[str] = frozenset()
+        self._outbuf = bytearray()
+        self._rxbuf = bytearray()
+        self._held_commands: Deque[bytes] = deque()
+        self._chan_by_name: 'OrderedDict[str, slack.Channel]' = OrderedDict()
+        self._user_by_name: 'OrderedDict[str, slack.User]' = OrderedDict()
+
+        # The substitutions depend on the provider, pick them only once
+        self._escape: Optional[Dict[int, str]]
+        self._at_subst: Tuple[re.Pattern, str]
+        self._incoming_subst: List[Tuple[re.Pattern, Callable[[re.Match], str]]]
+        self._yell_regexp: re.Pattern
+        self._mention_fmt: Callable[[str], str]
         if self.provider == Provider.SLACK:
-            self.substitutions = _SLACK_SUBSTITUTIONS
+            self._escape = _SLACK_ESCAPE
+            self._at_subst = (_SLACK_AT_REGEXP, r'<!\1>')
+            self._incoming_subst = [
+                (_MENTIONS_REGEXP, self._mention_sub),
+                (_CHANNEL_MENTIONS_REGEXP, _channel_sub),
+                (_URL_REGEXP, _url_sub),
+                (_SLACK_UNESCAPE_REGEXP, _unescape_sub),
+            ]
+            self._yell_regexp = _SLACK_YELL_REGEXP
+            self._mention_fmt = lambda username: '<@%s>' % self._user(username).id
         else:
-            self.substitutions = []
+            self._escape = None
+            self._at_subst = (_ROCKET_AT_REGEXP, '@channel')
+            self._incoming_subst = [
+                (_MENTIONS_REGEXP, self._mention_sub),
+            ]
+            self._yell_regexp = _ROCKET_YELL_REGEXP
+            self._mention_fmt = lambda username: f'@{username}'
+
+    def _cached_lookup(self, cache: 'OrderedDict[str, T]', name: str, lookup: Callable[[str], T]) -> T:
+        """
+        Looks up name in the cache, falling back to the lookup
+        function. The least recently used entries are dropped.
+
+        Failed lookups are not cached.
+        """
+        if name in cache:
+            cache.move_to_end(name)
+            return cache[name]
+        value = lookup(name)
+        cache[name] = value
+        if len(cache) > NAME_CACHE_SIZE:
+            cache.popitem(last=False)
+        return value
+
+    def _chan(self, name: str) -> slack.Channel:
+        """
+        Returns a channel object from its name, without the #
+
+        raises KeyError if it doesn't exist.
+        """
+        return self._cached_lookup(self._chan_by_name, name, self.sl_client.get_channel_by_name)
+
+    def _user(self, name: str) -> slack.User:
+        """
+        Returns a user object from its name
+
+        raises KeyError if it doesn't exist.
+        """
+        return self._cached_lookup(self._user_by_name, name, self.sl_client.get_user_by_name)
+
+    def _forget_names(self) -> None:
+        """
+        Clears the cached channels and users, because
+        they might have changed.
+        """
+        self._chan_by_name.clear()
+        self._user_by_name.clear()
 
     def _nickhandler(self, cmd: bytes) -> None:
         _, nick = cmd.split(b' ', 1)
@@ -121,30 +384,89 @@ class Client:
             self._sendreply(Replies.ERR_ERRONEUSNICKNAME, 'Incorrect nickname, use {}'.format(self.sl_client.login_info.self.name))
             # self._sendreply(Replies.ERR_ERRONEUSNICKNAME, 'Incorrect nickname, use %s' % self.sl_client.login_info.self.name)
 
-    def _sendreply(self, code: Union[int, Replies], message: Union[str, bytes], extratokens: Iterable[Union[str, bytes]] = []) -> None:
-        codeint = code if isinstance(code, int) else code.value
-        bytemsg = message if isinstance(message, bytes) else message.encode('utf8')
+    def _write(self, data: bytes) -> None:
+        """
+        Queues data to be sent to the IRC client.
 
-        extratokens = list(extratokens)
+        Nothing is sent until flush() is called, so all the lines
+        written by a handler go out together.
+        """
+        self._outbuf += data
 
-        extratokens.insert(0, self.nick)
+    @property
+    def pending(self) -> bool:
+        """
+        True if there is queued data that was not sent yet.
+        """
+        return bool(self._outbuf)
+
+    def flush(self) -> None:
+        """
+        Sends as much of the queued data as the socket
+        accepts without blocking.
 
+        What is left stays queued for the next flush, so a slow
+        IRC client does not stall the slack events.
+        """
+        if not self._outbuf:
+            return
         try:
-            self.s.send(b':%s %03d %s :%s\n' % (
-                self.hostname,
-                codeint,
-                b' '.join(i if isinstance(i, bytes) else i.encode('utf8') for i in extratokens),
-                bytemsg,
-            ))
-        except Exception as e:
-            log("self.s.send(:%s %03d %s: %s) got Exception %s" % (
-                self.hostname,
-                codeint,
-                b' '.join(i if isinstance(i, bytes) else i.encode('utf8') for i in extratokens),
-                bytemsg,
-                e
-            ))
+            sent = self.s.send(self._outbuf)
+        except BlockingIOError:
             return
+        except OSError as e:
+            log('Unable to send to the IRC client', e)
+            self._outbuf.clear()
+            return
+        del self._outbuf[:sent]
+
+    def feed(self, data: Union[bytes, memoryview]) -> None:
+        """
+        Queues data received from the IRC client.
+        """
+        self._rxbuf += data
+
+    def next_command(self, connected: bool = True) -> Optional[bytes]:
+        """
+        Returns the next complete line received from the IRC
+        client, or None if there is none yet.
+
+        Incomplete lines stay queued until the rest arrives.
+
+        When slack is not connected, only the commands that
+        don't need it are returned. The others are held, and
+        returned first once it is connected again.
+        """
+        if connected and self._held_commands:
+            return self._held_commands.popleft()
+        while True:
+            idx = self._rxbuf.find(b'\n')
+            if idx == -1:
+                return None
+            line = bytes(self._rxbuf[:idx]).strip()
+            del self._rxbuf[:idx + 1]
+            if not line:
+                continue
+            if connected or line.split(b' ', 1)[0].upper() in self._OFFLINE_COMMANDS:
+                return line
+            self._held_commands.append(line)
+
+    def _sendreply(self, code: Union[int, Replies], message: Union[str, bytes], extratokens: Iterable[Union[str, bytes]] = []) -> None:
+        codeint = code if isinstance(code, int) else code.value
+        bytemsg = message if isinstance(message, bytes) else message.encode('utf8')
+
+        # Build the reply directly in the output queue
+        b = self._outbuf
+        b += b':'
+        b += self.hostname
+        b += b' %03d ' % codeint
+        b += self.nick
+        for i in extratokens:
+            b += b' '
+            b += i if isinstance(i, bytes) else i.encode('utf8')
+        b += b' :'
+        b += bytemsg
+        b += b'\n'
 
     def _userhandler(self, cmd: bytes) -> None:
         #TODO USER salvo 8 * :Salvatore Tomaselli
@@ -155,28 +477,46 @@ class Client:
         self._sendreply(2, 'Your nickname must be: %s' % self.sl_client.login_info.self.name)
         self._sendreply(Replies.RPL_LUSERCLIENT, 'There are 1 users and 0 services on 1 server')
 
-        if self.autojoin and not self.nouserlist:
-            # We're about to load many users for each chan; instead of requesting each
-            # profile on its own, batch load the full directory.
-            self.sl_client.prefetch_users()
-
         if self.autojoin:
 
-            mpim_cutoff = datetime.datetime.utcnow() - MPIM_HIDE_DELAY
+            mpim_cutoff = time.time() - MPIM_HIDE_DELAY.total_seconds()
 
+            wanted = [
+                c for c in self.sl_client.channels()
+                if c.is_member and not (c.is_mpim and (c.latest is None or c.latest.ts < mpim_cutoff))
+            ]
+            # Smaller channels are quicker to join, do them first
+            wanted.sort(key=lambda c: c.num_members)
+            self._autojoin_queue.extend(wanted)
+        else:
             for sl_chan in self.sl_client.channels():
-                if not sl_chan.is_member:
-                    continue
+                self.parted_channels.add(_encode_channel(sl_chan.name_normalized))
 
-                if sl_chan.is_mpim and (sl_chan.latest is None or sl_chan.latest.timestamp < mpim_cutoff):
-                    continue
+        self.autojoin_step()
 
-                channel_name = '#%s' % sl_chan.name_normalized
-                self._send_chan_info(channel_name.encode('utf-8'), sl_chan)
-        else:
-            for sl_chan in self.sl_client.channels():
-                channel_name = '#%s' % sl_chan.name_normalized
-                self.parted_channels.add(channel_name.encode('utf-8'))
+    @property
+    def joining(self) -> bool:
+        """
+        True while there are channels left to autojoin.
+        """
+        return bool(self._autojoin_queue)
+
+    def autojoin_step(self) -> None:
+        """
+        Joins the next few channels of the autojoin.
+
+        Joining hundreds of channels takes a long time, so the
+        main loop calls this repeatedly, serving the IRC client
+        and reading the slack events in between.
+        """
+        for _ in range(AUTOJOIN_CHUNK):
+            if not self._autojoin_queue:
+                break
+            sl_chan = self._autojoin_queue.popleft()
+            self._send_chan_info(_encode_channel(sl_chan.name_normalized), sl_chan)
+
+        if self._autojoin_queue:
+            return
 
         # Eventual channel joining done, sending the held events
         self._usersent = True
@@ -186,17 +526,18 @@ class Client:
 
     def _pinghandler(self, cmd: bytes) -> None:
         _, lbl = cmd.split(b' ', 1)
-        self.s.send(b':%s PONG %s %s\n' % (self.hostname, self.hostname, lbl))
+        self._write(b':%s PONG %s %s\n' % (self.hostname, self.hostname, lbl))
 
     def _joinhandler(self, cmd: bytes) -> None:
         _, channel_name_b = cmd.split(b' ', 1)
+        self._forget_names()
 
         if channel_name_b in self.parted_channels:
             self.parted_channels.remove(channel_name_b)
 
         channel_name = channel_name_b[1:].decode()
         try:
-            slchan = self.sl_client.get_channel_by_name(channel_name)
+            slchan = self._chan(channel_name)
         except Exception:
             self._sendreply(Replies.ERR_NOSUCHCHANNEL, f'Unable to find channel: {channel_name}')
             return
@@ -213,8 +554,11 @@ class Client:
             self._sendreply(Replies.ERR_NOSUCHCHANNEL, f'Unable to join channel: {channel_name}')
 
     def _send_chan_info(self, channel_name: bytes, slchan: slack.Channel):
+        userlist: List[bytes] = []
         if not self.nouserlist:
-            userlist: List[bytes] = []
+            # We're about to load many users for each chan; instead of requesting each
+            # profile on its own, batch load the full directory
+            self.sl_client.prefetch_users()
             for i in self.sl_client.get_members(slchan.id):
                 try:
                     u = self.sl_client.get_user(i)
@@ -223,16 +567,15 @@ class Client:
                 if u.deleted:
                     # Disabled user, skip it
                     continue
-                name = u.name.encode('utf8')
+                name = _encode_name(u.name)
                 prefix = b'@' if u.is_admin else b''
                 userlist.append(prefix + name)
 
-            users = b' '.join(userlist)
-
-        # self.s.send(b':%s!salvo@127.0.0.1 JOIN %s\n' % (self.nick, channel_name))
-        self.s.send(b':%s!%s@127.0.0.1 JOIN %s\n' % (self.nick, self.nick, channel_name))
+        # self._write(b':%s!salvo@127.0.0.1 JOIN %s\n' % (self.nick, channel_name))
+        self._write(b':%s!%s@127.0.0.1 JOIN %s\n' % (self.nick, self.nick, channel_name))
         self._sendreply(Replies.RPL_TOPIC, slchan.real_topic, [channel_name])
-        self._sendreply(Replies.RPL_NAMREPLY, b'' if self.nouserlist else users, ['=', channel_name])
+        for names in list(_join_names(userlist)) or [b'']:
+            self._sendreply(Replies.RPL_NAMREPLY, names, ['=', channel_name])
         self._sendreply(Replies.RPL_ENDOFNAMES, 'End of NAMES list', [channel_name])
 
     def _privmsghandler(self, cmd: bytes) -> None:
@@ -253,14 +596,14 @@ class Client:
 
         if dest.startswith(b'#'):
             self.sl_client.send_message(
-                self.sl_client.get_channel_by_name(dest[1:].decode()).id,
+                self._chan(dest[1:].decode()).id,
                 message,
                 action,
             )
         else:
             try:
                 self.sl_client.send_message_to_user(
-                    self.sl_client.get_user_by_name(dest.decode()).id,
+                    self._user(dest.decode()).id,
                     message,
                     action,
                 )
@@ -268,6 +611,7 @@ class Client:
                 log('Impossible to find user ', dest)
 
     def _listhandler(self, cmd: bytes) -> None:
+        self._forget_names()
         for c in self.sl_client.channels(refresh=True):
             self._sendreply(Replies.RPL_LIST, c.real_topic, ['#' + c.name, str(c.num_members)])
         self._sendreply(Replies.RPL_LISTEND, 'End of LIST')
@@ -288,9 +632,9 @@ class Client:
 
         try:
             if channel_name.startswith('#'):
-                dest = self.sl_client.get_channel_by_name(channel_name[1:]).id
+                dest = self._chan(channel_name[1:]).id
             else:
-                dest = self.sl_client.get_user_by_name(channel_name).id
+                dest = self._user(channel_name).id
         except KeyError:
             self._sendreply(Replies.ERR_NOSUCHCHANNEL, f'Unable to find destination: {channel_name}')
             return
@@ -314,7 +658,7 @@ class Client:
     def _topichandler(self, cmd: bytes) -> None:
         _, channel_b, topic_b = cmd.split(b' ', 2)
         topic = topic_b.decode()[1:]
-        channel = self.sl_client.get_channel_by_name(channel_b.decode()[1:])
+        channel = self._chan(channel_b.decode()[1:])
         try:
             self.sl_client.topic(channel, topic)
         except Exception:
@@ -334,7 +678,7 @@ class Client:
             self._sendreply(Replies.ERR_UNKNOWNCOMMAND, 'Wildcards are not supported')
         uusername = username.decode()
         try:
-            user = self.sl_client.get_user_by_name(uusername)
+            user = self._user(uusername)
         except KeyError:
             self._sendreply(Replies.ERR_NOSUCHNICK, f'Unknown user {uusername}')
 
@@ -347,8 +691,8 @@ class Client:
 
     def _kickhandler(self, cmd: bytes) -> None:
         _, channel_b, username, message = cmd.split(b' ', 3)
-        channel = self.sl_client.get_channel_by_name(channel_b.decode()[1:])
-        user = self.sl_client.get_user_by_name(username.decode())
+        channel = self._chan(channel_b.decode()[1:])
+        user = self._user(username.decode())
         try:
             self.sl_client.kick(channel, user)
         except Exception as e:
@@ -365,8 +709,8 @@ class Client:
 
     def _invitehandler(self, cmd: bytes) -> None:
         _, username, channel_b = cmd.split(b' ', 2)
-        channel = self.sl_client.get_channel_by_name(channel_b.decode()[1:])
-        user = self.sl_client.get_user_by_name(username.decode())
+        channel = self._chan(channel_b.decode()[1:])
+        user = self._user(username.decode())
         try:
             self.sl_client.invite(channel, user)
         except Exception as e:
@@ -376,17 +720,19 @@ class Client:
         _, name = cmd.split(b' ', 1)
         if not name.startswith(b'#'):
             try:
-                user = self.sl_client.get_user_by_name(name.decode())
+                user = self._user(name.decode())
             except KeyError:
                 return
             self._sendreply(Replies.RPL_WHOREPLY, '0 %s' % user.real_name, [name, user.name, '127.0.0.1', self.hostname, user.name, 'H'])
             return
 
         try:
-            channel = self.sl_client.get_channel_by_name(name.decode()[1:])
+            channel = self._chan(name.decode()[1:])
         except KeyError:
             return
 
+        # Batch load the full directory, rather than each profile on its own
+        self.sl_client.prefetch_users()
         for i in self.sl_client.get_members(channel.id):
             try:
                 user = self.sl_client.get_user(i)
@@ -395,61 +741,83 @@ class Client:
                 pass
         self._sendreply(Replies.RPL_ENDOFWHO, 'End of WHO list', [name])
 
-    def sendmsg(self, from_: bytes, to: bytes, message: bytes) -> None:
-        # self.s.send(b':%s!salvo@127.0.0.1 PRIVMSG %s :%s\n' % (
-        self.s.send(b':%s!%s@127.0.0.1 PRIVMSG %s :%s\n' % (
+    def sendmsg(self, from_: bytes, to: bytes, *messages: bytes) -> None:
+        """
+        Sends one or more messages to the IRC client.
+
+        The lines share the same prefix, so it is built only once.
+        """
+        # prefix = b':%s!salvo@127.0.0.1 PRIVMSG %s :' % (
+        prefix = b':%s!%s@127.0.0.1 PRIVMSG %s :' % (
             from_,
             self.nick,
             to,  # private message, or a channel
-            message,
-        ))
+        )
+        b = self._outbuf
+        for message in messages:
+            b += prefix
+            b += message
+            b += b'\n'
 
     def _addmagic(self, msg: str) -> str:
         """
         Adds magic codes and various things to
         outgoing messages
         """
-        for i in self.substitutions:
-            msg = msg.replace(i[1], i[0])
-        if self.provider == Provider.SLACK:
-            msg = msg.replace('@here', '<!here>')
-            msg = msg.replace('@channel', '<!channel>')
-            msg = msg.replace('@everyone', '<!everyone>')
-        elif self.provider == Provider.ROCKETCHAT:
-            msg = msg.replace('@yell', '@channel')
-            msg = msg.replace('@shout', '@channel')
-            msg = msg.replace('@attention', '@channel')
-
-        # Extremely inefficient code to generate mentions
+        if self._escape:
+            msg = msg.translate(self._escape)
+        at_regexp, at_repl = self._at_subst
+        msg = at_regexp.sub(at_repl, msg)
+
+        # Code to generate mentions
         # Just doing them client-side on the receiving end is too mainstream
 
         if self._magic_users_id == id(self.sl_client.get_usernames()):
             regex = self._magic_regex
+            firstchars = self._magic_firstchars
             assert regex
         else:
             usernames = self.sl_client.get_usernames()
             assert usernames
             self._magic_users_id = id(usernames)
-            regexs = (r'((://\S*){0,1}\b%s\b)' % username for username in usernames)
-            regex = re.compile('|'.join(regexs))
+            regex, firstchars = _compile_mentions(frozenset(usernames))
             self._magic_regex = regex
+            self._magic_firstchars = firstchars
+
+        if firstchars.isdisjoint(msg):
+            return msg  # No username can possibly be in the message
+
+        urls = _url_spans(msg)
 
-        matches = list(re.finditer(regex, msg))
-        matches.reverse()  # I want to replace from end to start or the positions get broken
-        for m in matches:
-            username = m.string[m.start():m.end()]
-            if username.startswith('://'):
-                continue  # Match inside a url
-            elif self.provider == Provider.SLACK:
-                msg = msg[0:m.start()] + '<@%s>' % self.sl_client.get_user_by_name(username).id + msg[m.end():]
-            elif self.provider == Provider.ROCKETCHAT:
-                msg = msg[0:m.start()] + f'@{username}' + msg[m.end():]
-        return msg
+        def mention(m: re.Match) -> str:
+            username = m.group(0)
+            if _in_spans(m.start(), urls):
+                return username  # Match inside a url
+            return self._mention_fmt(username)
+        return regex.sub(mention, msg)
+
+    def _mention_sub(self, m: re.Match) -> str:
+        """
+        Callback to replace a slack mention with the username.
+
+        Unknown users are left as they are.
+        """
+        try:
+            return self.sl_client.get_user(m.group(1)).name
+        except KeyError:
+            return m.group(0)
+
+    def _yell_sub(self, m: re.Match) -> bytes:
+        """
+        Callback to replace a yell with a notification
+        containing the nickname.
+        """
+        return _YELLS[m.group(1)] % self.nick
 
     def parse_message(self, msg: str) -> Iterator[bytes]:
-        log("parse_message: msg=({}) ".format(msg))
+        debug('parse_message: msg=', msg)
         for i in msg.split('\n'):
-            log("parse_message: i=({}) ".format(i))
+            debug('parse_message: i=', i)
             if not i:
                 continue
 
@@ -460,63 +828,20 @@ class Client:
             if bot_rand:
                 rnd1, rnd2 = bot_rand.groups()
                 rndnum = random.randrange(int(rnd1), int(rnd2))
-                log("got a .rand request; rnd1={}, rnd2={}, rndnum={}".format(rnd1, rnd2, rndnum))
+                debug('got a .rand request; rnd1=', rnd1, 'rnd2=', rnd2, 'rndnum=', rndnum)
                 i = ".rand {} {} = {}".format(int(rnd1), int(rnd2), rndnum)
                 encoded = i.encode('utf8')
                 yield encoded
             ===============================================================
             """
 
-            # Replace all mentions with @user
-            while True:
-                mention = _MENTIONS_REGEXP.search(i)
-                if not mention:
-                    break
-                i = (
-                    i[0:mention.span()[0]] +
-                    self.sl_client.get_user(mention.groups()[0]).name +
-                    i[mention.span()[1]:]
-                )
+            # Replace mentions of users and channels, URLs and escapes
+            for regex, repl in self._incoming_subst:
+                i = regex.sub(repl, i)
+
+            encoded = self._yell_regexp.sub(self._yell_sub, i.encode('utf8'))
 
-            # Replace all channel mentions
-            if self.provider == Provider.SLACK:
-                while True:
-                    mention = _CHANNEL_MENTIONS_REGEXP.search(i)
-                    if not mention:
-                        break
-                    i = (
-                        i[0:mention.span()[0]] +
-                        '#' +
-                        mention.groups()[0] +
-                        i[mention.span()[1]:]
-                    )
-
-                while True:
-                    url = _URL_REGEXP.search(i)
-                    if not url:
-                        break
-                    schema, path, label = url.groups()
-                    i = (
-                        i[0:url.span()[0]] +
-                        f'{schema}://{path}' +
-                        (f' ({label})' if label else '') +
-                        i[url.span()[1]:]
-                    )
-
-            for s in self.substitutions:
-                i = i.replace(s[0], s[1])
-
-            encoded = i.encode('utf8')
-
-            if self.provider == Provider.SLACK:
-                encoded = encoded.replace(b'<!here>', b'yelling [%s]' % self.nick)
-                encoded = encoded.replace(b'<!channel>', b'YELLING LOUDER [%s]' % self.nick)
-                encoded = encoded.replace(b'<!everyone>', b'DEAFENING YELL [%s]' % self.nick)
-            elif self.provider == Provider.ROCKETCHAT:
-                encoded = encoded.replace(b'@here', b'yelling [%s]' % self.nick)
-                encoded = encoded.replace(b'@channel', b'YELLING LOUDER [%s]' % self.nick)
-
-            log("leaving parse_message encoded={}".format(encoded))
+            debug('leaving parse_message encoded=', encoded)
             yield encoded
 
     def _message(self, sl_ev: Union[slack.Message, slack.MessageDelete, slack.MessageBot, slack.ActionMessage], prefix: str = ''):
@@ -524,11 +849,11 @@ class Client:
         Sends a message to the irc client
         """
         if hasattr(sl_ev, 'user'):
-            source = self.sl_client.get_user(sl_ev.user).name.encode('utf8')  # type: ignore
+            source = _encode_name(self.sl_client.get_user(sl_ev.user).name)  # type: ignore
         else:
             source = b'bot'
         try:
-            dest = b'#' + self.sl_client.get_channel(sl_ev.channel).name.encode('utf8')
+            dest = _encode_channel(self.sl_client.get_channel(sl_ev.channel).name)
         except KeyError:
             dest = self.nick
         except Exception as e:
@@ -537,14 +862,10 @@ class Client:
         if dest in self.parted_channels:
             # Ignoring messages, channel was left on IRC
             return
-        for msg in self.parse_message(prefix + sl_ev.text):
-            if isinstance(sl_ev, slack.ActionMessage):
-                msg = b'\x01ACTION ' + msg + b'\x01'
-            self.sendmsg(
-                source,
-                dest,
-                msg
-            )
+        msgs = self.parse_message(prefix + sl_ev.text)
+        if isinstance(sl_ev, slack.ActionMessage):
+            msgs = (b'\x01ACTION ' + msg + b'\x01' for msg in msgs)
+        self.sendmsg(source, dest, *msgs)
 
     def _joined_parted(self, sl_ev: Union[slack.Join, slack.Leave], joined: bool) -> None:
         """
@@ -556,15 +877,15 @@ class Client:
             return
         try:
             channel = self.sl_client.get_channel(sl_ev.channel)
-            dest = b'#' + channel.name.encode('utf8')
+            dest = _encode_channel(channel.name)
             if dest in self.parted_channels:
                 return
-            name = user.name.encode('utf8')
-            rname = user.real_name.replace(' ', '_').encode('utf8')
+            name = _encode_name(user.name)
+            rname = _encode_name(user.real_name.replace(' ', '_'))
             if joined:
-                self.s.send(b':%s!%s@127.0.0.1 JOIN :%s\n' % (name, rname, dest))
+                self._write(b':%s!%s@127.0.0.1 JOIN :%s\n' % (name, rname, dest))
             else:
-                self.s.send(b':%s!%s@127.0.0.1 PART %s\n' % (name, rname, dest))
+                self._write(b':%s!%s@127.0.0.1 PART %s\n' % (name, rname, dest))
         except Exception as e:
             log("_joined_parted: channel {} is probably PRIVATE or threaded conversation!".format(channel))
 
@@ -593,8 +914,7 @@ class Client:
         elif isinstance(sl_ev, slack.TopicChange):
             self._sendreply(Replies.RPL_TOPIC, sl_ev.topic, ['#' + self.sl_client.get_channel(sl_ev.channel).name])
         elif isinstance(sl_ev, slack.GroupJoined):
-            channel_name = '#%s' % sl_ev.channel.name_normalized
-            self._send_chan_info(channel_name.encode('utf-8'), sl_ev.channel)
+            self._send_chan_info(_encode_channel(sl_ev.channel.name_normalized), sl_ev.channel)
 
     def command(self, cmd: bytes) -> None:
         if b' ' in cmd:
@@ -602,29 +922,9 @@ class Client:
         else:
             cmdid = cmd
 
-        handlers = {
-            b'NICK': self._nickhandler,
-            b'USER': self._userhandler,
-            b'PING': self._pinghandler,
-            b'JOIN': self._joinhandler,
-            b'PRIVMSG': self._privmsghandler,
-            b'LIST': self._listhandler,
-            b'WHO': self._whohandler,
-            b'MODE': self._modehandler,
-            b'PART': self._parthandler,
-            b'AWAY': self._awayhandler,
-            b'TOPIC': self._topichandler,
-            b'KICK': self._kickhandler,
-            b'INVITE': self._invitehandler,
-            b'sendfile': self._sendfilehandler,
-            #QUIT
-            #CAP LS
-            b'USERHOST': self._userhosthandler,
-            b'whois': self._whoishandler,
-        }
-
-        if cmdid in handlers:
-            handlers[cmdid](cmd)
+        handler = self._HANDLERS.get(cmdid.upper())
+        if handler:
+            getattr(self, handler)(cmd)
         else:
             self._sendreply(Replies.ERR_UNKNOWNCOMMAND, 'Unknown command', [cmdid])
             log('Unknown command: ', cmd)
@@ -657,6 +957,26 @@ def su() -> None:
     os.seteuid(userdata.pw_uid)
 
 
+def _drain(source: Callable[[], Optional[Any]], handler: Callable[[Any], None]) -> bool:
+    """
+    Passes the items from source to handler, until source
+    returns None or the budget of the main loop iteration
+    runs out.
+
+    Returns True if the budget ran out, so there might
+    be more items waiting.
+    """
+    deadline = time.monotonic() + LOOP_BUDGET_TIME
+    for _ in range(LOOP_BUDGET):
+        item = source()
+        if item is None:
+            return False
+        handler(item)
+        if time.monotonic() >= deadline:
+            return True
+    return True
+
+
 def main() -> None:
     su()
 
@@ -690,10 +1010,16 @@ def main() -> None:
                         help='Path to the file to keep the internal status.')
     parser.add_argument('--log-suffix', type=str, action='store', dest='log_suffix', default='',
                         help='Set a suffix for the syslog identifier')
+    parser.add_argument('-d', '--debug', action='store_true',
+                        dest='debug', required=False,
+                        help='Log every event, very verbose')
 
     args = parser.parse_args()
 
     openlog(environ.get('LOG_SUFFIX', args.log_suffix))
+    debug_mode: bool = environ['DEBUG'].lower() == 'true' if 'DEBUG' in environ else args.debug
+    if debug_mode:
+        enable_debug()
 
     status_file_str: Optional[str] = environ.get('STATUS_FILE', args.status_file)
     status_file = None
@@ -767,43 +1093,86 @@ def main() -> None:
     serversocket.listen(1)
 
     poller = select.poll()
+    rxbuf = bytearray(RECV_SIZE)
+    rxview = memoryview(rxbuf)
 
     while True:
         s, _ = serversocket.accept()
+        s.setblocking(False)
+        # Replies are already batched by flush(), don't delay them further
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         ircclient = Client(s, sl_client, nouserlist, autojoin, provider)
 
         poller.register(s.fileno(), select.POLLIN)
-        if sl_client.fileno is not None:
-            poller.register(sl_client.fileno, select.POLLIN)
+        sl_fileno: Optional[int] = None
+        busy = False
 
         # Main loop
-        timeout = 2
         while True:
-            s_event: List[Tuple[int, int]] = poller.poll(timeout)
-            sl_event = next(sl_events)
+            # The slack socket changes when reconnecting
+            if sl_client.fileno != sl_fileno:
+                if sl_fileno is not None:
+                    poller.unregister(sl_fileno)
+                sl_fileno = sl_client.fileno
+                if sl_fileno is not None:
+                    poller.register(sl_fileno, select.POLLIN)
+
+            # Wait for the IRC client to accept more data only if there is some queued
+            poller.modify(s.fileno(), (select.POLLIN | select.POLLOUT) if ircclient.pending else select.POLLIN)
+
+            # Sleep until one of the sockets is ready, unless there is still work to do
+            if busy or ircclient.joining:
+                timeout: Optional[int] = 0
+            elif sl_fileno is None:
+                timeout = RECONNECT_POLL
+            else:
+                timeout = None
+            s_event = dict(poller.poll(timeout))
 
-            if s_event:
-                text = s.recv(1024)
-                if len(text) == 0:
+            irc_event = s_event.get(s.fileno(), 0)
+            if irc_event & ~select.POLLOUT:
+                size = s.recv_into(rxbuf)
+                if size == 0:
                     break
-                #FIXME handle the case when there is more to be read
-                for i in text.split(b'\n')[:-1]:
-                    i = i.strip()
-                    if i:
-                        ircclient.command(i)
+                ircclient.feed(rxview[:size])
+
+            # Take turns between IRC and slack, so that a burst
+            # on one side doesn't starve the other.
+            # Most commands need slack, so they are held while it is disconnected
+            busy = _drain(partial(ircclient.next_command, sl_fileno is not None), ircclient.command)
+
+            if ircclient.joining:
+                ircclient.autojoin_step()
+
+            # Handling IRC commands and joining might queue internal
+            # slack events, so read slack only after
+            busy |= _drain(sl_events.__next__, ircclient.slack_event)
 
-            while sl_event:
-                log("in sl_event loop...")
-                ircclient.slack_event(sl_event)
-                sl_event = next(sl_events)
+            # Send everything queued in this iteration at once
+            ircclient.flush()
+
+            # Just connected: go around right away to handle the held commands
+            busy |= sl_client.fileno != sl_fileno
+
+        poller.unregister(s.fileno())
+        if sl_fileno is not None:
+            poller.unregister(sl_fileno)
 
 
 if __name__ == '__main__':
+    crashes = 0
     while True:
+        started = time.monotonic()
         try:
             main()
         except KeyboardInterrupt:
             break
-        except Exception as e:
-            traceback.print_last()
-            pass
+        except Exception:
+            log('Crashed, restarting')
+            log(traceback.format_exc())
+
+            # Wait longer at every crash, unless it had been running for a while
+            if time.monotonic() - started > 60:
+                crashes = 0
+            time.sleep(min(2 ** crashes, 60))
+            crashes += 1
@@ -21,12 +21,15 @@ from syslog import LOG_INFO, syslog
 from syslog import openlog as _openlog
 
 __all__ = [
+    'debug',
+    'enable_debug',
     'log',
     'openlog'
 ]
 
 
 tty = isatty(1) and isatty(2)
+_debug = False
 
 
 def openlog(suffix: str) -> None:
@@ -50,3 +53,23 @@ def log(*args) -> None:
         print(*args)
         return
     syslog(LOG_INFO, ' '.join(str(i) for i in args))
+
+
+def enable_debug() -> None:
+    """
+    Makes debug() log.
+    """
+    global _debug
+    _debug = True
+
+
+def debug(*args) -> None:
+    """
+    Like log, but does nothing unless debugging was enabled.
+
+    Meant for the very frequent messages, so the arguments
+    are passed as they are and only converted to strings
+    when they are actually logged.
+    """
+    if _debug:
+        log(*args)
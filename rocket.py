@@ -322,7 +322,8 @@ class Rocket:
         # Handle the stupid ping thing directly here
         if data == {'msg': 'ping'}:
             self._send_json({'msg': 'pong'})
-            return None
+            # There might be more data already buffered
+            return self._read(event_id, subs_id)
 
         # Search for results of function calls
         if data is not None and (event_id is not None or subs_id is not None):
@@ -349,7 +350,7 @@ class Rocket:
                 continue
 
             r: Optional[SlackEvent] = None
-            log('Scanning ', data)
+            debug('Scanning ', data)
             if not isinstance(data, dict):
                 continue
 
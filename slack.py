@@ -17,13 +17,15 @@
 # author Salvo "LtWorf" Tomaselli <tiposchi@tiscali.it>
 
 import datetime
+from collections import deque
 from dataclasses import dataclass, field
-from functools import lru_cache
+from functools import cached_property, lru_cache
 import json
-from time import sleep, time
+from time import monotonic, time
 from typing import *
 
-from typedload import load, dump
+from typedload import dump
+from typedload.dataloader import Loader
 
 from diff import seddiff
 from slackclient import SlackClient
@@ -31,7 +33,7 @@ from slackclient.client import LoginInfo
 from log import *
 
 
-USELESS_EVENTS = {
+USELESS_EVENTS = frozenset({
     'channel_marked',
     'group_marked',
     'mpim_marked',
@@ -43,7 +45,14 @@ USELESS_EVENTS = {
     'file_public',
     'file_created',
     'desktop_notification',
-}
+})
+
+
+#: Seconds after which a cached user is fetched again
+USER_CACHE_TTL = 1800
+
+#: Seconds after which the list of channels is fetched again
+CHANNELS_CACHE_TTL = 3600
 
 
 class ResponseException(Exception):
@@ -66,11 +75,12 @@ class Topic(NamedTuple):
     value: str
 
 
-class LatestMessage(NamedTuple):
+@dataclass(frozen=True)
+class LatestMessage:
     ts: float
 
-    @property
-    def timestamp(self):
+    @cached_property
+    def timestamp(self) -> datetime.datetime:
         return datetime.datetime.utcfromtimestamp(self.ts)
 
 
@@ -125,6 +135,7 @@ class ActionMessage(Message):
 
 @dataclass
 class GroupJoined:
+    __slots__ = ('type', 'channel')
     type: Literal['group_joined']
     channel: Channel
 
@@ -152,6 +163,7 @@ class MessageEdit:
 
 @dataclass
 class MessageDelete:
+    __slots__ = ('type', 'subtype', 'channel', 'previous_message')
     type: Literal['message']
     subtype: Literal['message_deleted']
     channel: str
@@ -191,20 +203,18 @@ class File:
         """
         Returns a message to announce this file.
         """
+        # The last one, as if the lists were concatenated
+        channel = self.ims[-1] if self.ims else self.groups[-1] if self.groups else self.channels[-1]
         return Message(
-            channel=(self.channels + self.groups + self.ims).pop(),
+            channel=channel,
             user=self.user,
-            text='[file upload] %s\n%s %d bytes\n%s' % (
-                self.name,
-                self.mimetype,
-                self.size,
-                self.url_private
-            )
+            text=f'[file upload] {self.name}\n{self.mimetype} {self.size} bytes\n{self.url_private}'
         )
 
 
 @dataclass
 class FileShared:
+    __slots__ = ('type', 'file_id', 'user_id', 'ts')
     type: Literal['file_shared']
     file_id: str
     user_id: str
@@ -252,6 +262,7 @@ class Leave(NamedTuple):
 
 @dataclass
 class TopicChange:
+    __slots__ = ('type', 'subtype', 'topic', 'channel', 'user')
     type: Literal['message']
     subtype: Literal['group_topic']
     topic: str
@@ -268,7 +279,7 @@ class HistoryBotMessage:
     username: str = 'bot'
     ts: float = 0
     files: List[File] = field(default_factory=list)
-    thread_ts: Optional[str] = None
+    thread_ts: Optional[float] = None
 
 
 @dataclass
@@ -278,7 +289,7 @@ class HistoryMessage:
     text: str
     ts: float
     files: List[File] = field(default_factory=list)
-    thread_ts: Optional[str] = None
+    thread_ts: Optional[float] = None
 
 
 class NextCursor(NamedTuple):
@@ -305,6 +316,12 @@ SlackEvent = Union[
     GroupJoined,
 ]
 
+#: The events that are loaded straight from the RTM events
+_EVENT_TYPES: Any = Union[TopicChange, FileShared, MessageBot, MessageEdit, MessageDelete, GroupJoined, Join, Leave]
+
+#: Shared by all the loads, creating a new Loader every time is slow
+_loader = Loader()
+
 
 @dataclass
 class SlackStatus:
@@ -319,45 +336,56 @@ class SlackStatus:
 class Slack:
     def __init__(self, token: str, cookie: Optional[str], previous_status: Optional[bytes]) -> None:
         self.client = SlackClient(token, cookie)
-        self._usercache: Dict[str, User] = {}
+        self._usercache: Dict[str, Tuple[float, User]] = {}
         self._usermapcache: Dict[str, User] = {}
         self._imcache: Dict[str, str] = {}
+        self._im_reverse: Dict[str, str] = {}
         self._get_members_cache: Dict[str, Set[str]] = {}
         self._get_members_cache_cursor: Dict[str, Optional[str]] = {}
         self._internalevents: List[SlackEvent] = []
         self._sent_by_self: Set[float] = set()
+        self._sent_by_self_queue: Deque[Tuple[float, float]] = deque()
+        self._channels_ts = 0.0
+        self._users_ts = 0.0
+        self._channels_list: List[Channel] = []
+        self._channels_by_id: Dict[str, Channel] = {}
+        self._channels_by_name: Dict[str, Channel] = {}
+        self._next_retry_at = 0.0
         self.login_info: Optional[LoginInfo] = None
         if previous_status is None:
             self._status = SlackStatus()
         else:
-            self._status = load(json.loads(previous_status), SlackStatus)
+            self._status = _loader.load(json.loads(previous_status), SlackStatus)
 
-    def _thread_history(self, channel: str, thread_id: str) -> List[Union[HistoryMessage, HistoryBotMessage]]:
+    def _thread_history(self, channel: str, thread_id: float) -> List[Union[HistoryMessage, HistoryBotMessage]]:
         r: List[Union[HistoryMessage, HistoryBotMessage]] = []
         cursor = None
-        log('Thread history', channel, thread_id)
+        debug('Thread history', channel, thread_id)
         while True:
-            log('Cursor')
+            debug('Cursor')
             p = self.client.api_call(
                 'conversations.replies',
                 channel=channel,
-                ts=thread_id,
+                ts='%.6f' % thread_id,
                 limit=1000,
                 cursor=cursor,
             )
             try:
-                response = load(p, History)
+                response = _loader.load(p, History)
             except Exception as e:
                 log('Failed to parse', e)
                 log(p)
                 break
-            r += [i for i in response.messages if i.ts != i.thread_ts]
+            # The parent is repeated in every page, keep it only once
+            r += [i for i in response.messages if not r or i.ts != i.thread_ts]
             if response.has_more and response.response_metadata:
                 cursor = response.response_metadata.next_cursor
             else:
                 break
-        log('Thread fetched')
-        r[0].thread_ts = None
+        debug('Thread fetched')
+        if r:
+            # Do not fetch the thread again when the parent is handled
+            r[0].thread_ts = None
         return r
 
     def _history(self) -> None:
@@ -372,17 +400,16 @@ class Slack:
             return
 
         last_timestamp = self._status.last_timestamp
-        dt = datetime.datetime.fromtimestamp(last_timestamp)
-        log(f'Last known timestamp {dt}')
+        log('Last known timestamp', datetime.datetime.fromtimestamp(last_timestamp))
 
         for channel in self.channels():
             if not channel.is_member:
                 continue
-            log(f'Downloading logs from channel {channel.name_normalized}')
+            debug('Downloading logs from channel', channel.name_normalized)
 
             cursor = None
             while True:  # Loop to iterate the cursor
-                log('Calling cursor')
+                debug('Calling cursor')
                 r = self.client.api_call(
                     'conversations.history',
                     channel=channel.id,
@@ -391,14 +418,14 @@ class Slack:
                     cursor=cursor,
                 )
                 try:
-                    response = load(r, History)
+                    response = _loader.load(r, History)
                 except Exception as e:
                     log('Failed to parse', e)
                     log(r)
                     break
-                msg_list = list(response.messages)
+                msg_list = deque(response.messages)
                 while msg_list:
-                    msg = msg_list.pop(0)
+                    msg = msg_list.popleft()
 
                     # The last seen message is sent again, skip it
                     if msg.ts == last_timestamp:
@@ -413,10 +440,9 @@ class Slack:
                         self._internalevents.append(f.announce())
 
                     # History for the thread
-                    if  msg.thread_ts and float(msg.thread_ts) == msg.ts:
-                        l = self._thread_history(channel.id, msg.thread_ts)
-                        l.reverse()
-                        msg_list = l + msg_list
+                    if msg.thread_ts is not None and msg.thread_ts == msg.ts:
+                        # extendleft prepends the thread in reverse order
+                        msg_list.extendleft(self._thread_history(channel.id, msg.thread_ts))
                         continue
 
                     # Inject the events
@@ -452,25 +478,25 @@ class Slack:
         """
         status = 'away' if is_away else 'auto'
         r = self.client.api_call('users.setPresence', presence=status)
-        response = load(r, Response)
+        response = _loader.load(r, Response)
         if not response.ok:
             raise ResponseException(response)
 
     def topic(self, channel: Channel, topic: str) -> None:
         r = self.client.api_call('conversations.setTopic', channel=channel.id, topic=topic)
-        response = load(r, Response)
+        response = _loader.load(r, Response)
         if not response.ok:
             raise ResponseException(response)
 
     def kick(self, channel: Channel, user: User) -> None:
         r = self.client.api_call('conversations.kick', channel=channel.id, user=user.id)
-        response = load(r, Response)
+        response = _loader.load(r, Response)
         if not response.ok:
             raise ResponseException(response)
 
     def join(self, channel: Channel) -> None:
         r = self.client.api_call('conversations.join', channel=channel.id)
-        response = load(r, Response)
+        response = _loader.load(r, Response)
         if not response.ok:
             raise ResponseException(response)
 
@@ -483,7 +509,7 @@ class Slack:
             ids = ','.join(i.id for i in user)
 
         r = self.client.api_call('conversations.invite', channel=channel.id, users=ids)
-        response = load(r, Response)
+        response = _loader.load(r, Response)
         if not response.ok:
             raise ResponseException(response)
 
@@ -511,31 +537,39 @@ class Slack:
         if cursor:
             kwargs['cursor'] = cursor
         r = self.client.api_call('conversations.members', channel=id_, limit=5000, **kwargs)  # type: ignore
-        response = load(r, Response)
+        response = _loader.load(r, Response)
         if not response.ok:
             raise ResponseException(response)
 
-        newusers = load(r['members'], Set[str])
+        # A plain list of ids, no need to go through typedload
+        newusers = set(r['members'])
 
         # Generate all the Join events, if this is not the 1st iteration
         if id_ in self._get_members_cache:
             for i in newusers.difference(cached):
                 self._internalevents.append(Join('member_joined_channel', user=i, channel=id_))
+            cached |= newusers
+        else:
+            cached = self._get_members_cache[id_] = newusers
 
-        self._get_members_cache[id_] = cached.union(newusers)
         self._get_members_cache_cursor[id_] = r.get('response_metadata', {}).get('next_cursor')
-        return self._get_members_cache[id_]
+        return cached
 
-    @lru_cache()
-    def _channels(self) -> List[Channel]:
-        result: List[Channel] = []
+    def _fetch_channels(self) -> None:
+        """
+        Downloads the list of channels and indexes it
+        by id and by name.
+        """
         r = self.client.api_call("conversations.list", exclude_archived=True,
                 types='public_channel,private_channel,mpim', limit=1000)
-        response = load(r, Response)
-        if response.ok:
-            return load(r['channels'], List[Channel])
-        else:
+        response = _loader.load(r, Response)
+        if not response.ok:
             raise ResponseException(response)
+        channels = _loader.load(r['channels'], List[Channel])
+        self._channels_list = channels
+        self._channels_by_id = {c.id: c for c in channels}
+        self._channels_by_name = {c.name: c for c in channels}
+        self._channels_ts = time()
 
     def channels(self, refresh: bool = False) -> List[Channel]:
         """
@@ -543,35 +577,34 @@ class Slack:
 
         if refresh is set, the local cache is cleared
         """
-        if refresh:
-            self._channels.cache_clear()
-        return self._channels()
+        if refresh or time() - self._channels_ts >= CHANNELS_CACHE_TTL:
+            self._fetch_channels()
+        return self._channels_list
 
-    @lru_cache()
     def get_channel(self, id_: str) -> Channel:
         """
         Returns a channel object from a slack channel id
 
         raises KeyError if it doesn't exist.
         """
-        for i in range(2):
-            for c in self.channels(refresh=bool(i)):
-                if c.id == id_:
-                    return c
-        raise KeyError()
+        # IMs are never in the list, don't download it again for them
+        if id_.startswith('D'):
+            raise KeyError(id_)
+        self.channels()
+        if id_ not in self._channels_by_id:
+            self.channels(refresh=True)
+        return self._channels_by_id[id_]
 
-    @lru_cache()
     def get_channel_by_name(self, name: str) -> Channel:
         """
         Returns a channel object from a slack channel id
 
         raises KeyError if it doesn't exist.
         """
-        for i in range(2):
-            for c in self.channels(refresh=bool(i)):
-                if c.name == name:
-                    return c
-        raise KeyError()
+        self.channels()
+        if name not in self._channels_by_name:
+            self.channels(refresh=True)
+        return self._channels_by_name[name]
 
     @property
     def fileno(self) -> Optional[int]:
@@ -580,16 +613,23 @@ class Slack:
     def get_im(self, im_id: str) -> Optional[IM]:
         if not im_id.startswith('D'):
             return None
-        for uid, imid in self._imcache.items():
-            if im_id == imid:
-                return IM(user=uid, id=imid)
+        uid = self._im_reverse.get(im_id)
+        if uid is not None:
+            return IM(user=uid, id=im_id)
 
         for im in self.get_ims():
-            self._imcache[im.user] = im.id
+            self._cache_im(im.user, im.id)
             if im.id == im_id:
                 return im
         return None
 
+    def _cache_im(self, user_id: str, im_id: str) -> None:
+        """
+        Caches the IM of a user, in both directions.
+        """
+        self._imcache[user_id] = im_id
+        self._im_reverse[im_id] = user_id
+
     def get_ims(self) -> List[IM]:
         """
         Returns a list of the IMs
@@ -603,9 +643,9 @@ class Slack:
             exclude_archived=True,
             types='im', limit=1000
         )
-        response = load(r, Response)
+        response = _loader.load(r, Response)
         if response.ok:
-            return load(r['channels'], List[IM])
+            return _loader.load(r['channels'], List[IM])
         raise ResponseException(response)
 
     def get_user_by_name(self, name: str) -> User:
@@ -618,33 +658,64 @@ class Slack:
     def prefetch_users(self) -> None:
         """
         Prefetch all team members for the slack team.
+
+        Does nothing if the last attempt is more recent
+        than USER_CACHE_TTL, so it is cheap to call often.
+        A failed attempt is not repeated earlier either,
+        users.list is heavily rate limited.
         """
+        if time() - self._users_ts < USER_CACHE_TTL:
+            return
+        self._users_ts = time()
         r = self.client.api_call("users.list")
-        response = load(r, Response)
+        response = _loader.load(r, Response)
         if response.ok:
-            for user in load(r['members'], List[User]):
-                self._usercache[user.id] = user
-                self._usermapcache[user.name] = user
+            for user in _loader.load(r['members'], List[User]):
+                self._cache_user(user)
+
+    def _cache_user(self, user: User) -> None:
+        """
+        Stores a new or updated user in the caches.
+        """
+        old = self._usercache.get(user.id)
+        self._usercache[user.id] = (time(), user)
+        if old is not None and old[1].name != user.name:
+            # Renamed, the old name is gone
+            self._usermapcache.pop(old[1].name, None)
             self.get_usernames.cache_clear()
+        elif user.name not in self._usermapcache:
+            self.get_usernames.cache_clear()
+        self._usermapcache[user.name] = user
 
     def get_user(self, id_: str) -> User:
         """
         Returns a user object from a slack user id
 
         raises KeyError if it does not exist
-        """
-        if id_ in self._usercache:
-            return self._usercache[id_]
 
-        r = self.client.api_call("users.info", user=id_)
-        response = load(r, Response)
-        if response.ok:
-            u = load(r['user'], User)
-            self._usercache[id_] = u
-            if u.name not in self._usermapcache:
-                self.get_usernames.cache_clear()
-            self._usermapcache[u.name] = u
+        Cached users are fetched again after USER_CACHE_TTL
+        seconds. If that fails the old data is used, and kept
+        for another USER_CACHE_TTL.
+        """
+        cached = self._usercache.get(id_)
+        if cached is not None and time() - cached[0] < USER_CACHE_TTL:
+            return cached[1]
+
+        try:
+            r = self.client.api_call("users.info", user=id_)
+            response: Optional[Response] = _loader.load(r, Response)
+        except Exception:
+            if cached is None:
+                raise
+            response = None
+        if response is not None and response.ok:
+            u = _loader.load(r['user'], User)
+            self._cache_user(u)
             return u
+        elif cached is not None:
+            # Keep the old data, and don't ask again at every lookup
+            self._usercache[id_] = (time(), cached[1])
+            return cached[1]
         else:
             raise KeyError(response)
 
@@ -654,9 +725,9 @@ class Slack:
         """
         fileid = f if isinstance(f, str) else f.file_id
         r = self.client.api_call("files.info", file=fileid)
-        response = load(r, Response)
+        response = _loader.load(r, Response)
         if response.ok:
-            return load(r['file'], File)
+            return _loader.load(r['file'], File)
         else:
             raise KeyError(response)
 
@@ -672,7 +743,7 @@ class Slack:
                 channels=channel_id,
                 files=files,
             )
-        response = load(r, Response)
+        response = _loader.load(r, Response)
         if response.ok:
             return
         raise ResponseException(response)
@@ -681,13 +752,14 @@ class Slack:
         """
         Clear all the old leftovers in
         _sent_by_self
+
+        The queue is in insertion order, so only the
+        expired items at its head need to be looked at.
         """
-        r = []
-        for i in self._sent_by_self:
-            if time() - i >= 10:
-                r.append(i)
-        for i in r:
-            self._sent_by_self.remove(i)
+        expired = time() - 10
+        queue = self._sent_by_self_queue
+        while queue and queue[0][0] <= expired:
+            self._sent_by_self.discard(queue.popleft()[1])
 
     def send_message(self, channel_id: str, msg: str, action: bool) -> None:
         """
@@ -703,9 +775,10 @@ class Slack:
             text=msg,
             as_user=True,
         )
-        response = load(r, Response)
+        response = _loader.load(r, Response)
         if response.ok and response.ts:
             self._sent_by_self.add(response.ts)
+            self._sent_by_self_queue.append((time(), response.ts))
             return
         raise ResponseException(response)
 
@@ -737,18 +810,25 @@ class Slack:
                     return_im=True,
                     user=user_id,
                 )
-                response = load(r, Response)
+                response = _loader.load(r, Response)
                 if not response.ok:
                     raise ResponseException(response)
                 channel_id = r['channel']['id']
 
-            self._imcache[user_id] = channel_id
+            self._cache_im(user_id, channel_id)
 
         self.send_message(channel_id, msg, action)
 
     def events_iter(self) -> Iterator[Optional[SlackEvent]]:
         """
-        This yields an event or None. Don't call it without sleeps
+        This yields an event or None.
+
+        None is yielded only once there is nothing left to read,
+        so it is safe to wait on the fileno after that.
+
+        When the connection fails, this does not wait before
+        trying again, it yields None and fileno is None until
+        the next attempt is due.
         """
         log("entered events_iter...")
         sleeptime = 1
@@ -760,25 +840,34 @@ class Slack:
             try:
                 events = self.client.rtm_read()
             except Exception:
-                events = []
+                self.client.rtm_disconnect()
+                if monotonic() < self._next_retry_at:
+                    yield None
+                    continue
                 log('Connecting to slack...')
                 try:
                     self.login_info = self.client.rtm_connect()
+                    # Connected, the next disconnection starts over from a short delay
                     sleeptime = 1
                     self._history()
                 except Exception as e:
                     log(f'Connection to slack failed {e}')
-                    sleep(sleeptime)
-                    if sleeptime <= 120:  # max reconnection interval at 2 minutes
-                        sleeptime *= 2
+                    self.client.rtm_disconnect()
+                    self._next_retry_at = monotonic() + sleeptime
+                    sleeptime = min(sleeptime * 2, 120)  # max reconnection interval at 2 minutes
+                    yield None
                     continue
                 log('Connected to slack')
                 continue
 
             for event in events:
                 t = event.get('type')
-                ts = float(event.get('ts', 0))
-                log("envent type: %s (ts: %f)" % (t, ts))
+                if t in USELESS_EVENTS:
+                    continue
+
+                ts_str = event.get('ts')
+                ts = float(ts_str) if ts_str else 0.0
+                debug('event type:', t, 'ts:', ts)
 
                 if ts > self._status.last_timestamp:
                     self._status.last_timestamp = ts
@@ -787,14 +876,8 @@ class Slack:
                     self._sent_by_self.remove(ts)
                     continue
 
-                if t in USELESS_EVENTS:
-                        continue
-
                 try:
-                    ev = load(
-                        event,
-                        Union[TopicChange, FileShared, MessageBot, MessageEdit, MessageDelete, GroupJoined, Join, Leave]
-                    )
+                    ev = _loader.load(event, _EVENT_TYPES)
                 except Exception:
                     ev = None
 
@@ -812,16 +895,16 @@ class Slack:
                         ev = None
 
                 if ev:
-                    log("yielding event ev...")
+                    debug('yielding event', ev)
                     yield ev
 
 
                 subt = event.get('subtype')
-                log("   subtype: %s" % (subt))
+                debug('   subtype:', subt)
 
                 try:
                     if t == 'message' and (not subt or subt == 'me_message'):
-                        msg = load(event, Message)
+                        msg = _loader.load(event, Message)
 
                         # In private chats, pretend that my own messages
                         # sent from another client actually come from
@@ -834,17 +917,15 @@ class Slack:
                         else:
                             yield msg
                     elif t == 'message' and subt == 'slackbot_response':
-                        yield load(event, Message)
+                        yield _loader.load(event, Message)
                     elif t == 'user_change':
-                        # Changes in the user, drop it from cache
-                        u = load(event['user'], User)
-                        if u.id in self._usercache:
-                            del self._usercache[u.id]
-                            #FIXME don't know if it is wise, maybe it gets lost forever del self._usermapcache[u.name]
+                        # Changes in the user, update the cache
+                        self._cache_user(_loader.load(event['user'], User))
                         #TODO make an event for this
                     else:
                         log(event)
                 except Exception as e:
                     log('Exception: %s' % e)
             self._triage_sent_by_self()
-            yield None
+            if not events:
+                yield None
@@ -129,6 +129,15 @@ class SlackClient:
         else:
             raise SlackLoginError(reply=login_data)
 
+    def rtm_disconnect(self) -> None:
+        """
+        Drops the websocket, if there is one, without waiting
+        for the server.
+        """
+        if self._websocket is not None:
+            self._websocket.shutdown()
+            self._websocket = None
+
     def _connect_slack_websocket(self, ws_url):
         """Uses http proxy if available"""
         if self._proxies and 'http' in self._proxies:
@@ -150,27 +159,23 @@ class SlackClient:
 
     def _websocket_read(self) -> str:
         """
-        Returns data if available, otherwise ''. Newlines indicate multiple
-        messages
+        Returns one message if available, otherwise ''.
         """
         if self._websocket is None:
             raise SlackConnectionError("Unable to send due to closed RTM websocket")
 
-        data = ''
-        while True:
-            try:
-                data += "{0}\n".format(self._websocket.recv())
-            except SSLWantReadError:
-                # errno 2 occurs when trying to read or write data, but more
-                # data needs to be received on the underlying TCP transport
-                # before the request can be fulfilled.
-                #
-                # Python 2.7.9+ and Python 3.3+ give this its own exception,
-                # SSLWantReadError
-                return ''
-            except WebSocketConnectionClosedException:
-                raise SlackConnectionError("Unable to send due to closed RTM websocket")
-            return data.rstrip()
+        try:
+            return self._websocket.recv()
+        except SSLWantReadError:
+            # errno 2 occurs when trying to read or write data, but more
+            # data needs to be received on the underlying TCP transport
+            # before the request can be fulfilled.
+            #
+            # Python 2.7.9+ and Python 3.3+ give this its own exception,
+            # SSLWantReadError
+            return ''
+        except WebSocketConnectionClosedException:
+            raise SlackConnectionError("Unable to send due to closed RTM websocket")
 
     def api_call(self, method: str, timeout: Optional[float] = None, **kwargs) -> Dict[str, Any]:
         """
@@ -207,14 +212,13 @@ class SlackClient:
         else:
             files = None
         response = self._api_requester.do(method, kwargs, timeout, files)
-        response_json = json.loads(response.text)
+        # Let json detect the encoding, rather than decoding the text first
+        response_json = json.loads(response.content)
         response_json["headers"] = dict(response.headers)
         return response_json
 
     def rtm_read(self) -> List[Dict[str, Any]]:
         json_data = self._websocket_read()
-        data = []
-        if json_data != '':
-            for d in json_data.split('\n'):
-                data.append(json.loads(d))
-        return data
+        if json_data:
+            return [json.loads(json_data)]
+        return []
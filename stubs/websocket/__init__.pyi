@@ -5,3 +5,4 @@ def create_connection(url, timeout: Optional[int] = None, **kwargs): ...
 class WebSocket:
     def fileno(self) -> int: ...
     def recv(self) -> str: ...
+    def shutdown(self) -> None: ...
@@ -18,7 +18,7 @@
 
 import unittest
 
-from irc import _MENTIONS_REGEXP, _CHANNEL_MENTIONS_REGEXP, _URL_REGEXP, Client, Provider
+from irc import _MENTIONS_REGEXP, _CHANNEL_MENTIONS_REGEXP, _URL_REGEXP, _drain, _join_names, Client, Provider
 from slack import User
 
 
@@ -27,17 +27,64 @@ class TestTesto(unittest.TestCase):
         cases = [
             # String, matched groups
             ('q1://p1|p', None),
-            ('Pinnello <q1://p1|p>', ('q1', 'p1', 'p')),
-            ('Pinnello <q1://p1|p> asd asd', ('q1', 'p1', 'p')),
-            ('<q1://p1|p> asd asd', ('q1', 'p1', 'p')),
-            ('<q1://p1|p a|> asd asd', ('q1', 'p1', 'p a|')),
-            ('<q1://p1> asd asd', ('q1', 'p1', '')),
+            ('Pinnello <q1://p1|p>', ('q1://p1', 'p')),
+            ('Pinnello <q1://p1|p> asd asd', ('q1://p1', 'p')),
+            ('<q1://p1|p> asd asd', ('q1://p1', 'p')),
+            ('<q1://p1|p a|> asd asd', ('q1://p1', 'p a|')),
+            ('<q1://p1> asd asd', ('q1://p1', None)),
+            ('<svn+ssh://p1>', ('svn+ssh://p1', None)),
+            ('<q1://p1 p> asd asd', None),
+            ('<q1://' + 'p' * 50000, None),
+            ('<' + 'a://' * 10000, None),
         ]
 
         for url, expected in cases:
             m = _URL_REGEXP.search(url)
             assert m is None if expected is None else m.groups() == expected
 
+class TestNames(unittest.TestCase):
+    def test_join_names(self):
+        assert list(_join_names([])) == []
+        assert list(_join_names([b'a', b'b', b'c'])) == [b'a b c']
+        assert list(_join_names([b'aa', b'bb', b'cc'], 5)) == [b'aa bb', b'cc']
+        assert list(_join_names([b'aaaaaa', b'b'], 5)) == [b'aaaaaa', b'b']
+        for chunk in _join_names([b'LtWorf'] * 1000):
+            assert len(chunk) <= 400
+
+class TestFraming(unittest.TestCase):
+    def test_next_command(self):
+        client = Client(None, None, False, True, Provider.SLACK)
+        assert client.next_command() is None
+        client.feed(b'NICK LtWorf\r\nUSER a\n\r\nPRIV')
+        assert client.next_command() == b'NICK LtWorf'
+        assert client.next_command() == b'USER a'
+        assert client.next_command() is None
+        client.feed(b'MSG #a :b\n')
+        assert client.next_command() == b'PRIVMSG #a :b'
+        assert client.next_command() is None
+
+    def test_held_commands(self):
+        client = Client(None, None, False, True, Provider.SLACK)
+        client.feed(b'USER a\nping x\nJOIN #a\nMODE #a\n')
+        assert client.next_command(False) == b'ping x'
+        assert client.next_command(False) == b'MODE #a'
+        assert client.next_command(False) is None
+        client.feed(b'PING y\n')
+        assert client.next_command() == b'USER a'
+        assert client.next_command() == b'JOIN #a'
+        assert client.next_command() == b'PING y'
+        assert client.next_command() is None
+
+    def test_drain(self):
+        items = list(range(25))
+        handled = []
+        source = lambda: items.pop(0) if items else None
+        assert _drain(source, handled.append)
+        assert handled == list(range(10))
+        assert _drain(source, handled.append)
+        assert not _drain(source, handled.append)
+        assert handled == list(range(25))
+
 class TestMagic(unittest.TestCase):
 
     def setUp(self):
@@ -48,6 +95,10 @@ class TestMagic(unittest.TestCase):
                 return self.usernames
             def get_user_by_name(self, username):
                 return User(username, username, None)
+            def get_user(self, id_):
+                if id_ in self.usernames:
+                    return User(id_, id_, None)
+                raise KeyError(id_)
 
         self.mock_client = MockClient()
         self.client = Client(None, self.mock_client, False, True, Provider.SLACK)
@@ -61,6 +112,8 @@ class TestMagic(unittest.TestCase):
             'http://LtWorf/',
             'ciao https://link.com/LtWorf',
             'ciao https://link.com/LtWorf?param',
+            'https://LtWorf.com https://link.com/LtWorf',
+            'LtWorf://link',
         ]
         for i in cases:
             assert self.client._addmagic(i) == i
@@ -79,6 +132,11 @@ class TestMagic(unittest.TestCase):
         self.client._addmagic('ciao')
         assert initial != id(self.client._magic_regex)
 
+    def test_no_firstchars(self):
+        self.mock_client.usernames = ['myself', 'yourself']
+        assert self.client._addmagic('ciao') == 'ciao'
+        assert self.client._addmagic('ciao myself') == 'ciao <@myself>'
+
     def test_escapes(self):
         assert self.client._addmagic('<') == '&lt;'
         assert self.client._addmagic('>ciao') == '&gt;ciao'
@@ -93,3 +151,43 @@ class TestMagic(unittest.TestCase):
         assert self.client._addmagic('LtWorf: ciao') == '<@LtWorf>: ciao'
         assert self.client._addmagic('_LtWorf') == '_LtWorf'
         assert self.client._addmagic('LtWorf: http://link/user=LtWorf') == '<@LtWorf>: http://link/user=LtWorf'
+        assert self.client._addmagic('http://link/LtWorf LtWorf') == 'http://link/LtWorf <@LtWorf>'
+
+    def test_mentions_prefixes(self):
+        self.mock_client.usernames = ['Lt', 'LtWorf', 'LtWorfo', 'salvo']
+        assert self.client._addmagic('ciao Lt') == 'ciao <@Lt>'
+        assert self.client._addmagic('ciao LtWorf') == 'ciao <@LtWorf>'
+        assert self.client._addmagic('LtWorfo, LtWorf, Lt') == '<@LtWorfo>, <@LtWorf>, <@Lt>'
+        assert self.client._addmagic('LtWorfon salvo') == 'LtWorfon <@salvo>'
+
+    def test_parse_message(self):
+        cases = [
+            ('ciao', [b'ciao']),
+            ('ciao\n\ncome va?', [b'ciao', b'come va?']),
+            ('ciao <@LtWorf> e <@U1234>', [b'ciao LtWorf e <@U1234>']),
+            ('vai su <#C1234|general>', [b'vai su #general']),
+            ('<http://link.com|link> <http://link.com>', [b'http://link.com (link) http://link.com']),
+            ('&lt;b&gt; &amp;amp;', [b'<b> &amp;']),
+        ]
+        for msg, expected in cases:
+            assert list(self.client.parse_message(msg)) == expected
+
+    def test_parse_yells(self):
+        self.client.nick = b'LtWorf'
+        cases = [
+            ('<!here> ciao', [b'yelling [LtWorf] ciao']),
+            ('<!channel> <!everyone>', [b'YELLING LOUDER [LtWorf] DEAFENING YELL [LtWorf]']),
+        ]
+        for msg, expected in cases:
+            assert list(self.client.parse_message(msg)) == expected
+
+    def test_regex_cache_same_users(self):
+        '''
+        Check that a new list with the same users reuses the regex
+        '''
+        self.mock_client.usernames = ['myself', 'yourself']
+        self.client._addmagic('ciao')
+        initial = id(self.client._magic_regex)
+        self.mock_client.usernames = ['yourself', 'myself']
+        self.client._addmagic('ciao')
+        assert initial == id(self.client._magic_regex)